@@ -8,6 +8,7 @@ from collections.abc import Iterable
 from rouge_score import rouge_scorer
 from typing import List, Mapping, Optional
 
+from lm_eval.api.utils import DEFAULT_SEED
 from lm_eval.metrics import sari as sari_impl
 
 
@@ -323,7 +324,39 @@ class _BootstrapInternal:
         return res
 
 
+# Metrics that are a function of the sample mean, mapped to that function.
+# Their bootstrap replicates can be computed with vectorized `numpy` reductions
+# over all resamples at once instead of one Python-level call per resample.
+_MEAN_BASED_METRICS = {
+    mean: lambda means: means,
+    perplexity: lambda means: np.exp(-means),
+}
+
+# Upper bound on the number of resampled items held in memory at once.
+_MAX_BOOTSTRAP_CHUNK_ELEMENTS = 10_000_000
+
+
+def _vectorized_bootstrap_stderr(f, xs, iters, seed=DEFAULT_SEED):
+    rng = np.random.default_rng(seed)
+    xs = np.asarray(xs, dtype=np.float64)
+    n = len(xs)
+    chunk_size = max(1, min(iters, _MAX_BOOTSTRAP_CHUNK_ELEMENTS // n))
+    means = []
+    for start in range(0, iters, chunk_size):
+        # Sample w replacement: one row of resampled indices per bootstrap.
+        idx = rng.integers(0, n, size=(min(chunk_size, iters - start), n))
+        means.append(xs[idx].mean(axis=1))
+    res = _MEAN_BASED_METRICS[f](np.concatenate(means))
+    if len(res) == 1:
+        # Match `sample_stddev`, which is 0 for a single replicate.
+        return 0.0
+    return float(np.std(res, ddof=1))
+
+
 def bootstrap_stderr(f, xs, iters):
+    if f in _MEAN_BASED_METRICS:
+        return _vectorized_bootstrap_stderr(f, xs, iters)
+
     import multiprocessing as mp
 
     pool = mp.Pool(mp.cpu_count())
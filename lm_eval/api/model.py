@@ -3,8 +3,7 @@ import hashlib
 import json
 import os
 import torch
-import torch.nn.functional as F
-from tqdm import tqdm
+from tqdm.auto import tqdm
 from typing import Iterable, List, Optional, Tuple, Union
 from transformers import BatchEncoding
 
@@ -123,7 +122,10 @@ class TokenLM(LM):
     """
 
     @abc.abstractmethod
-    def tok_encode(self, string: str):
+    def tok_encode(self, string: Union[str, List[str]]):
+        """Encodes a string, or a list of strings in a single batched call, into
+        token ids (a list of token id lists, respectively).
+        """
         pass
 
     @abc.abstractmethod
@@ -162,55 +164,89 @@ class TokenLM(LM):
     def device(self) -> Union[int, str, torch.device]:
         pass
 
+    def _padded_length(self, length: int) -> int:
+        """Returns the length to pad a batch whose longest sequence has `length`
+        tokens to. Models can override this to pad to fewer distinct lengths,
+        e.g. to limit recompilation of compiled models.
+        """
+        return length
+
     def loglikelihood(
         self, requests: List[Tuple[str, str]]
     ) -> List[Tuple[float, bool]]:
-        new_requests = []
-        for context, continuation in requests:
-            if context == "":
-                # End of text as context
-                context_enc = [self.eot_token_id]
-            else:
-                context_enc = self.tok_encode(context)
-            continuation_enc = self.tok_encode(continuation)
-            new_requests.append(
-                ((context, continuation), context_enc, continuation_enc)
+        if not requests:
+            return []
+        # Tokenize all contexts and continuations with one batched call each
+        # instead of once per request. Multiple-choice requests share their
+        # context, so each distinct context is only encoded once.
+        unique_contexts = list(dict.fromkeys(context for context, _ in requests))
+        context_to_enc = dict(zip(unique_contexts, self.tok_encode(unique_contexts)))
+        # End of text as context
+        context_to_enc[""] = [self.eot_token_id]
+        continuations_enc = self.tok_encode(
+            [continuation for _, continuation in requests]
+        )
+        new_requests = [
+            ((context, continuation), context_to_enc[context], continuation_enc)
+            for (context, continuation), continuation_enc in zip(
+                requests, continuations_enc
             )
+        ]
         return self._loglikelihood_tokens(new_requests)
 
     def loglikelihood_rolling(self, requests: List[Tuple[str, str]]) -> List[float]:
         # TODO: Implement caching once we've confirmed the perplexity implementation
         # TODO: Automatic batch size detection for vectorization
-        loglikelihoods = []
-        for (string,) in tqdm(requests):
-            rolling_token_windows = list(
+        if not requests:
+            return []
+        rolling_token_windows, window_string_ids = self._rolling_token_windows(requests)
+        # TODO: Figure out partial caching for the rolling windows.
+        window_nlls = self._loglikelihood_tokens(
+            [(None,) + window for window in rolling_token_windows],
+            compute_greedy=False,
+        )
+        loglikelihoods = [0.0] * len(requests)
+        # Discard `is_greedy`
+        for string_id, (window_nll, _) in zip(window_string_ids, window_nlls):
+            loglikelihoods[string_id] += window_nll
+        return loglikelihoods
+
+    def _rolling_token_windows(
+        self, requests: List[Tuple[str]]
+    ) -> Tuple[List[Tuple[TokenSequence, TokenSequence]], List[int]]:
+        """Splits every string in `requests` into disjoint rolling
+        `(context, continuation)` token windows of at most `max_length` tokens.
+
+        Returns:
+            The windows of all strings, in order, and the index of the string
+            each window belongs to. Building them up front lets windows from
+            different strings be scored in the same batch.
+        """
+        # Tokenize all strings with one batched call instead of once per request.
+        strings_enc = self.tok_encode([string for (string,) in requests])
+        rolling_token_windows, window_string_ids = [], []
+        for string_id, string_enc in enumerate(strings_enc):
+            string_windows = list(
                 map(
                     utils.make_disjoint_window,
                     utils.get_rolling_token_windows(
-                        token_list=self.tok_encode(string),
+                        token_list=string_enc,
                         prefix_token=self.eot_token_id,
                         max_seq_len=self.max_length,
                         context_len=1,
                     ),
                 )
             )
-            rolling_token_windows = [(None,) + x for x in rolling_token_windows]
-            # TODO: Extract out this call so it only gets called once and
-            # also somehow figure out partial caching for that.
-            string_nll = self._loglikelihood_tokens(
-                rolling_token_windows, disable_tqdm=True
-            )
-            # Discard `is_greedy`
-            string_nll = [x[0] for x in string_nll]
-            string_nll = sum(string_nll)
-            loglikelihoods.append(string_nll)
-        return loglikelihoods
+            rolling_token_windows.extend(string_windows)
+            window_string_ids.extend([string_id] * len(string_windows))
+        return rolling_token_windows, window_string_ids
 
     def _loglikelihood_tokens(
         self,
         requests: List[Tuple[Tuple[str, str], TokenSequence, TokenSequence]],
         disable_tqdm: Optional[bool] = False,
-    ) -> List[Tuple[float, bool]]:
+        compute_greedy: Optional[bool] = True,
+    ) -> List[Tuple[float, Optional[bool]]]:
         """Helper method for computing log-likelihood of generating a
         continuation from a context that have both been tokenized/encoded.
 
@@ -231,6 +267,9 @@ class TokenLM(LM):
                     The tokenized/encoded continuation.
             disable_tqdm (bool, optional, defaults to False):
                 Whether to disable `tqdm` progress bar.
+            compute_greedy (bool, optional, defaults to True):
+                Whether to check if each continuation is the greedy one. Callers
+                that discard `isgreedy` can skip the extra pass over the logits.
 
         Returns:
             A list of pairs (logprob, isgreedy):
@@ -238,6 +277,7 @@ class TokenLM(LM):
                     The log probability of `continuation`.
                 isgreedy (float):
                     Whether `continuation` would be generated by greedy sampling from `context`.
+                    None if `compute_greedy` is False.
         """
 
         def _collate(x):
@@ -250,90 +290,176 @@ class TokenLM(LM):
             tokens = x[1] + x[2]
             return -len(tokens), tuple(tokens)
 
+        def _collect_results(chunk, logprobs, max_equals, copied):
+            # Read the whole batch's results back at once instead of syncing
+            # on every request.
+            if copied is not None:
+                copied.synchronize()
+            max_equals = (
+                max_equals.tolist() if max_equals is not None else [None] * len(chunk)
+            )
+            for (cache_key, _, _), logprob, max_equal in zip(
+                chunk, logprobs.tolist(), max_equals
+            ):
+                # Answer: (log prob, is-exact-match)
+                answer = (logprob, max_equal)
+                # Partial caching
+                if cache_key is not None:
+                    self.cache_hook.add_partial("loglikelihood", cache_key, answer)
+                results.append(answer)
+
         # TODO: Automatic (variable) batch size detection for vectorization
         # TODO: Implement some kind of efficient-request-middleware that lumps together requests with the same context
         results = []
         reorder = utils.Reorderer(requests, _collate)
+        pending = None
+        # Throttle progress bar refreshes; each request is cheap to iterate.
         for chunk in utils.chunks(
-            tqdm(reorder.get_reordered(), disable=disable_tqdm), self.batch_size
+            tqdm(
+                reorder.get_reordered(),
+                disable=disable_tqdm,
+                mininterval=1.0,
+                miniters=max(1, len(requests) // 100),
+            ),
+            self.batch_size,
         ):
-            inputs = []
-            input_lens = []
-            cont_tokens_list = []
-            padding_length = None
-
-            # Because vectorizing is annoying, we first convert each (context, continuation) pair to padded
-            # tensors, then we pack them together into a batch, call the model, and then pick it all apart
-            # again because vectorizing is annoying
-            for _, context_enc, continuation_enc in chunk:
-                # sanity check
-                assert len(context_enc) > 0
-                assert len(continuation_enc) > 0
-                assert len(continuation_enc) <= self.max_length
-
-                # How this all works:
-                #          CTX      CONT
-                # inp    0 1 2 3|4 5 6 7 8 9   <- last token is deleted by inp[:, :-1]
-                # gpt2    \               \
-                # logits   1 2 3|4 5 6 7 8 9   <- the ctx half gets tossed out by the
-                # cont_tokens      4 5 6 7 8 9      [:, -len(continuation_enc):, :self.vocab_size] slice
-
-                # When too long to fit in context, truncate from the left
-                _full_enc = context_enc + continuation_enc
-                input = torch.tensor(
-                    _full_enc[-(self.max_length + 1) :][:-1],
-                    dtype=torch.long,
-                ).to(self.device)
-                (input_len,) = input.shape
-
-                # Since in _collate we make sure length is descending, the longest is always the first one.
-                padding_length = (
-                    padding_length if padding_length is not None else input_len
-                )
-
-                # Pad length from seq to padding_length
-                input = torch.cat(
-                    [
-                        input,  # [seq]
-                        torch.zeros(padding_length - input_len, dtype=torch.long).to(
-                            input.device
-                        ),  # [padding_length - seq]
-                    ],
-                    dim=0,
-                )
-                inputs.append(input.unsqueeze(0))  # [1, padding_length]
-                cont_tokens_list.append(continuation_enc)
-                input_lens.append(input_len)
+            # Queue this batch on the device before reading back the previous
+            # batch's results, so building the next batch on the host overlaps
+            # with the model's forward pass.
+            batch = (chunk, *self._loglikelihood_batch(chunk, compute_greedy))
+            if pending is not None:
+                _collect_results(*pending)
+            pending = batch
+        if pending is not None:
+            _collect_results(*pending)
+        return reorder.get_original(results)
 
-            batched_inputs = torch.cat(inputs, dim=0)  # [batch, padding_length]
-            multi_logits = F.log_softmax(
-                self._model_call(batched_inputs), dim=-1
-            ).cpu()  # [batch, padding_length, vocab]
+    @torch.inference_mode()
+    def _loglikelihood_batch(
+        self,
+        chunk: List[Tuple[Tuple[str, str], TokenSequence, TokenSequence]],
+        compute_greedy: Optional[bool] = True,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional["torch.cuda.Event"]]:
+        """Runs the model on a batch of `_loglikelihood_tokens` requests.
 
-            for (cache_key, _, _), logits, input, input_len, cont_tokens in zip(
-                chunk, multi_logits, inputs, input_lens, cont_tokens_list
-            ):
-                # Slice to original seq length
-                cont_len = len(cont_tokens)
-                # [1, seq, vocab]
-                logits = logits[input_len - cont_len : input_len].unsqueeze(0)
-                # Check if per-token argmax is exactly equal to continuation
-                greedy_tokens = logits.argmax(dim=-1)
-                # [1, seq]
-                cont_tokens = torch.tensor(cont_tokens, dtype=torch.long).unsqueeze(0)
-                max_equal = (greedy_tokens == cont_tokens).all()
-
-                # Obtain logprobs at the corresponding continuation token indices
-                # last_token_slice = logits[:, -1, :].squeeze(0).tolist()
-                # [1, seq]
-                logits = torch.gather(logits, 2, cont_tokens.unsqueeze(-1)).squeeze(-1)
-                # Answer: (log prob, is-exact-match)
-                answer = (float(logits.sum()), bool(max_equal))
-                # Partial caching
-                if cache_key is not None:
-                    self.cache_hook.add_partial("loglikelihood", cache_key, answer)
-                results.append(answer)
-        return reorder.get_original(results)
+        Returns:
+            The continuation log-probs and greedy matches as tensors of shape
+            [batch]; the greedy matches are None unless `compute_greedy`. On
+            CUDA these are being copied to the host asynchronously and the
+            returned event must be synchronized before reading them; otherwise
+            the event is None.
+        """
+        inputs = []
+        cont_positions = []
+        cont_tokens_list = []
+        cont_masks = []
+        padding_length = None
+        span_start, span_end = None, 0
+        max_cont_len = max(len(continuation_enc) for _, _, continuation_enc in chunk)
+
+        # Because vectorizing is annoying, we first truncate each (context, continuation) pair to a list of
+        # token ids, then we pad and pack them together into a batch tensor with a single allocation, call the
+        # model, and then pick out the continuation positions of every row at once
+        for _, context_enc, continuation_enc in chunk:
+            # sanity check
+            assert len(context_enc) > 0
+            assert len(continuation_enc) > 0
+            assert len(continuation_enc) <= self.max_length
+
+            # How this all works:
+            #          CTX      CONT
+            # inp    0 1 2 3|4 5 6 7 8 9   <- last token is deleted by inp[:, :-1]
+            # gpt2    \               \
+            # logits   1 2 3|4 5 6 7 8 9   <- the ctx half gets tossed out by the
+            # cont_tokens      4 5 6 7 8 9      [:, -len(continuation_enc):, :self.vocab_size] slice
+
+            # When too long to fit in context, truncate from the left
+            _full_enc = context_enc + continuation_enc
+            input = _full_enc[-(self.max_length + 1) :][:-1]
+            input_len = len(input)
+
+            # Since in _collate we make sure length is descending, the longest is always the first one.
+            if padding_length is None:
+                padding_length = self._padded_length(input_len)
+
+            # Pad length from seq to padding_length
+            inputs.append(input + [0] * (padding_length - input_len))
+
+            # Positions of the continuation logits in the (unpadded) input,
+            # right-padded to the longest continuation in the batch with the
+            # row's last position.
+            cont_len = len(continuation_enc)
+            cont_pad = [0] * (max_cont_len - cont_len)
+            cont_positions.append(
+                list(range(input_len - cont_len, input_len))
+                + [input_len - 1] * len(cont_pad)
+            )
+            cont_tokens_list.append(continuation_enc + cont_pad)
+            cont_masks.append([1] * cont_len + cont_pad)
+            # Track the span of input positions covered by any continuation.
+            if span_start is None or input_len - cont_len < span_start:
+                span_start = input_len - cont_len
+            span_end = max(span_end, input_len)
+
+        # Make the positions relative to the start of the continuation span.
+        cont_positions = [
+            [position - span_start for position in positions]
+            for positions in cont_positions
+        ]
+
+        # [batch, padding_length]
+        batched_inputs = torch.tensor(inputs, dtype=torch.long)
+        # Pack the continuation positions, tokens and mask for the whole batch
+        # into a single allocation. [3, batch, max_cont_len]
+        cont_index = torch.tensor(
+            [cont_positions, cont_tokens_list, cont_masks], dtype=torch.long
+        )
+        if torch.device(self.device).type == "cuda":
+            # Page-locked host memory lets the copies below run asynchronously
+            # instead of going through a pageable staging buffer.
+            batched_inputs = batched_inputs.pin_memory()
+            cont_index = cont_index.pin_memory()
+        batched_inputs = batched_inputs.to(self.device, non_blocking=True)
+        # Keep the logits on the model's device; only the selected
+        # continuation values are read back by the caller.
+        # [batch, padding_length, vocab]
+        multi_logits = self._model_call(batched_inputs)
+
+        cont_index = cont_index.to(multi_logits.device, non_blocking=True)
+        cont_positions, cont_tokens = cont_index[0], cont_index[1]
+        cont_mask = cont_index[2].bool()
+        # Slice (rather than index) the positions covered by any continuation
+        # so that no copy of the logits is made; for rolling windows this is
+        # the whole input. [batch, span, vocab]
+        logits = multi_logits[:, span_start:span_end]
+        rows = torch.arange(len(chunk), device=logits.device).unsqueeze(-1)
+        max_equals = None
+        if compute_greedy:
+            # Check if per-token argmax is exactly equal to continuation
+            greedy_tokens = logits.argmax(dim=-1)[rows, cont_positions]
+            max_equals = ((greedy_tokens == cont_tokens) | ~cont_mask).all(dim=-1)
+        # Obtain logprobs at the corresponding continuation token indices as
+        # log_softmax(x)_i = x_i - logsumexp(x), without materializing the full
+        # log-probs. The normalizers are reduced in float32 even if the model
+        # returns half precision logits. [batch, max_cont_len]
+        cont_logits = logits[rows, cont_positions, cont_tokens].float()
+        cont_logits = (
+            cont_logits - utils.logsumexp_float32(logits)[rows, cont_positions]
+        )
+        logprobs = cont_logits.masked_fill(~cont_mask, 0.0).sum(dim=-1)
+
+        copied = None
+        if logprobs.is_cuda:
+            # Start copying the results back to the host right away so they are
+            # already there once the next batch has been queued; the event marks
+            # when the copy is done without waiting on later work.
+            stream = torch.cuda.current_stream(logprobs.device)
+            logprobs = logprobs.to("cpu", non_blocking=True)
+            if max_equals is not None:
+                max_equals = max_equals.to("cpu", non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(stream)
+        return logprobs, max_equals, copied
 
     @abc.abstractmethod
     def _model_call(
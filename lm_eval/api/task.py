@@ -369,14 +369,16 @@ class PromptSourceTask(Task):
         for idx in random_indices():
             if i >= k:  # Break when we have enough examples.
                 break
+            # Materialize the candidate row once; each `docs[idx]` decodes it anew.
+            doc = docs[idx]
             is_same_prompt = prompt is not None and all(
                 # Skips the `doc_id` key assigned to `prompt`s during eval pre-processing.
-                docs[idx][k] == prompt[k]
-                for k in docs[idx].keys()
+                doc[key] == prompt[key]
+                for key in doc.keys()
             )
-            if self.invalid_doc_for_prompt(docs[idx]) or is_same_prompt:
+            if self.invalid_doc_for_prompt(doc) or is_same_prompt:
                 continue
-            fewshot_examples.append(docs[idx])
+            fewshot_examples.append(doc)
             fewshot_idx.append(int(idx))
             i += 1
         return fewshot_examples, fewshot_idx
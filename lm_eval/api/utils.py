@@ -83,61 +83,6 @@ def get_rolling_token_windows(
         predicted += window_pred_len
 
 
-def split_and_pad_windows(
-    windows: List[Tuple[str, str]], pad_token_id: int, max_seq_len: int
-) -> Tuple[List[int], List[int]]:
-    """Splits and pads a sequence of rolling context and continuation windows
-    from `get_rolling_token_windows`.
-
-    Example:
-        [
-            ([1] , [23, 19, 3]),  # (context, continuation)
-            ([43], [2, 4]])
-        ]
-
-    Output:
-        [
-            [[1],[43]],                # Split & padded contexts.
-            [[23, 19, 3], [2, 4, 1]]`  # Split & padded continuations.
-        ]
-        where `1` = `pad_token` id.
-
-    Args:
-        windows (List[Tuple[str, str]]):
-            A generator of rolling `(context, continuation)` token windows
-            (tuples).
-        pad_token_id (int):
-            The token id to pad with.
-        max_seq_len (int):
-            The maximum sequence length of the model or a length we want to use.
-
-    Returns:
-        A tuple of (context, continuation) padding windows.
-    """
-    contexts, continuations = zip(*windows)
-    contexts, continuations = list(contexts), list(continuations)
-
-    # Pad contexts:
-    rollover_context = contexts[-1]
-    rollover_context_size = len(rollover_context)
-    # Handle empty final context token list - just add 1 token.
-    if rollover_context_size == 0:
-        contexts[-1] += [pad_token_id]
-    elif rollover_context_size > 1:
-        for i in range(len(contexts[:-1])):
-            contexts[i] += [pad_token_id] * (rollover_context_size - len(contexts[i]))
-
-    # Pad continuations:
-    rollover_continuation = continuations[-1]
-    rollover_continuation_size = len(rollover_continuation)
-    is_multiple_windows = len(continuations) > 1
-    if rollover_continuation_size < max_seq_len and is_multiple_windows:
-        continuations[-1] = rollover_continuation + [pad_token_id] * (
-            max_seq_len - rollover_continuation_size
-        )
-    return contexts, continuations
-
-
 def make_disjoint_window(pair):
     """Takes output from get_rolling_token_windows and makes the context not
     overlap with the continuation.
@@ -169,6 +114,33 @@ def select_continuation_from_batch_left_padding(
     return generations[:, max_context_size:]
 
 
+def logsumexp_float32(logits: torch.Tensor, max_numel: int = 2**26) -> torch.Tensor:
+    """Returns the float32 `logsumexp` of `logits` over the last (vocab) dim.
+
+    Only a few sequence positions at a time are upcast, so the reduction is
+    done in float32 for half precision logits without a float32 copy of the
+    full logits.
+
+    Args:
+        logits (torch.Tensor):
+            A tensor of shape [batch, sequence, vocab] in any float dtype.
+        max_numel (int, optional, defaults to 2**26):
+            The maximum number of logits upcast at once.
+
+    Returns:
+        A float32 tensor of shape [batch, sequence].
+    """
+    batch_size, seq_len, vocab_size = logits.shape
+    step = max(1, max_numel // max(1, batch_size * vocab_size))
+    return torch.cat(
+        [
+            logits[:, start : start + step].float().logsumexp(dim=-1)
+            for start in range(0, seq_len, step)
+        ],
+        dim=1,
+    )
+
+
 # Container Utils
 
 
@@ -1,11 +1,17 @@
 import collections
-import itertools
+import hashlib
+import importlib.metadata
+import inspect
 import json
 import logging
+import os
+import pickle
 import sys
+import tempfile
 import numpy as np
+import promptsource
 from tqdm import tqdm
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import lm_eval.models
 import lm_eval.tasks
@@ -62,7 +68,8 @@ def cli_evaluate(
         device (str, optional, defaults to None):
             PyTorch device (e.g. "cpu" or "cuda:0") for running models.
         use_cache (bool, optional, defaults to False):
-            Whether or not to use a cache for language model results.
+            Whether or not to use a cache for language model results and
+            the constructed language model requests.
         bootstrap_iters (int, optional, defaults to 100000):
             Number of iterations for bootstrap statistics.
         seed (int, optional, defaults to 1234 = `DEFAULT_SEED`):
@@ -94,6 +101,7 @@ def cli_evaluate(
         bootstrap_iters=bootstrap_iters,
         seed=seed,
         limit=limit,
+        requests_cache_dir="lm_cache" if use_cache else None,
     )
 
     # Add info about the model and few shot config.
@@ -120,6 +128,7 @@ def evaluate(
     bootstrap_iters: Optional[int] = 100000,
     seed: Optional[int] = DEFAULT_SEED,
     limit: Optional[int] = None,
+    requests_cache_dir: Optional[str] = None,
 ) -> dict:
     """Instantiate and evaluate a model on a list of tasks.
 
@@ -138,6 +147,10 @@ def evaluate(
         limit (int, optional, defaults to None):
             Limit the number of examples per task.
             WARNING: This is only for testing purposes.
+        requests_cache_dir (str, optional, defaults to None):
+            If given, the directory to save the constructed language model
+            requests into and load them from on subsequent evaluations of the
+            same tasks and few-shot config.
 
     Returns:
         Dictionary of results.
@@ -161,81 +174,72 @@ def evaluate(
 
     results = collections.defaultdict(dict)
     versions = collections.defaultdict(dict)
-    requests = collections.defaultdict(list)
-    requests_origin = collections.defaultdict(list)
-
-    # TODO: We need unit tests & sanity checks or something to ensure that the return of `validation_docs` is stable
-    docs = {}
-
-    # Build contexts and collect language model requests.
     for task_template_key, task in task_dict.items():
-        task_docs = task.evaluation_docs()
+        versions[task_template_key] = task.VERSION
 
-        logger.info(f"\n» Assigning unique IDs to '{task_template_key}' docs")
-        task_docs = task_docs.map(
-            lambda ex, idx: {**ex, "doc_id": idx}, with_indices=True
+    requests_cache_path = None
+    if requests_cache_dir is not None:
+        requests_cache_key = _get_requests_cache_key(
+            task_dict, num_fewshot=num_fewshot, seed=seed, limit=limit
+        )
+        requests_cache_path = os.path.join(
+            requests_cache_dir, f"requests_{requests_cache_key}.pkl"
         )
 
-        logger.info(f"\n» Filtering invalid docs from '{task_template_key}'")
-        task_docs = task_docs.filter(lambda d: not task.invalid_doc_for_prompt(d))
-        task_docs = task_docs.shuffle(generator=rng)
-
-        logger.info(f"\n» Constructing '{task_template_key}' contexts and requests")
-        pbar_limit = len(task_docs) if not limit else np.minimum(limit, len(task_docs))
-
-        for doc_id, doc in enumerate(
-            tqdm(itertools.islice(task_docs, 0, limit), total=pbar_limit)
-        ):
-            docs[(task_template_key, doc_id)] = doc
-            ctx, fewshotex_logging_info = task.fewshot_context(
-                doc=doc,
-                num_fewshot=num_fewshot,
-                rng=rng,
-            )
-            fewshotex_logging_info["doc_id"] = doc["doc_id"]
-            args = {"num_fewshot": num_fewshot}
-            reqs = task.construct_requests(doc, ctx, args)
-            if not isinstance(reqs, (list, tuple)):
-                reqs = [reqs]
-            for i, req in enumerate(reqs):
-                requests[req.request_type].append(req)
-                # i: Index in requests for a single task instance
-                # doc_id: Unique id that we can get back to a doc using `docs`
-                requests_origin[req.request_type].append(
-                    (i, task_template_key, doc, doc_id, fewshotex_logging_info)
-                )
-        # Store the task version.
-        versions[task_template_key] = task.VERSION
+    if requests_cache_path is not None and os.path.exists(requests_cache_path):
+        logger.info(f"\n» Loading cached requests from '{requests_cache_path}'")
+        with open(requests_cache_path, "rb") as f:
+            requests, requests_origin, docs = pickle.load(f)
+    else:
+        requests, requests_origin, docs = _construct_requests(
+            task_dict, num_fewshot=num_fewshot, rng=rng, limit=limit
+        )
+        if requests_cache_path is not None:
+            _save_requests_cache(requests_cache_path, (requests, requests_origin, docs))
 
-    # All responses for each (task, doc)
-    process_response_queue = collections.defaultdict(list)
+    # All responses for each (task, doc) in request index order, along with
+    # the doc's few-shot logging info.
+    process_response_queue = {}
     # Execute each type of request
     for reqtype, reqs in requests.items():
-        # TODO: Right now, this code runs multiple separate LM requests for
-        # multiple Requests differing only in index. We could implement some
-        # kind of caching, but that would be more of a band-aid solution. We
-        # could also implement some kind of auto-grouping here; they should
-        # end up next to each other.
+        # Requests differing only in index (e.g. `rf.loglikelihood(...)[0]` and
+        # `rf.loglikelihood(...)[1]`) end up next to each other, so group each
+        # run of identical args into a single LM request.
+        unique_args = []
+        unique_arg_idx = []
+        for req in reqs:
+            if not unique_args or req.args != unique_args[-1]:
+                unique_args.append(req.args)
+            unique_arg_idx.append(len(unique_args) - 1)
+
         logger.info(f"\n» Running all `{reqtype}` requests")
-        resps = getattr(model, reqtype)([req.args for req in reqs])
+        resps = getattr(model, reqtype)(unique_args)
         resps = [
-            x if req.index is None else x[req.index] for x, req in zip(resps, reqs)
+            resps[j] if req.index is None else resps[j][req.index]
+            for j, req in zip(unique_arg_idx, reqs)
         ]
         for resp, (i, task_template_key, doc, doc_id, fewshotex_logging_info) in zip(
             resps, requests_origin[reqtype]
         ):
-            process_response_queue[(task_template_key, doc_id)].append(
-                (i, resp, fewshotex_logging_info)
-            )
-
-    # Unpack results and sort back in order and return control to Task
+            per_doc_queue = process_response_queue.get((task_template_key, doc_id))
+            if per_doc_queue is None:
+                per_doc_queue = ([], fewshotex_logging_info)
+                process_response_queue[(task_template_key, doc_id)] = per_doc_queue
+            per_doc_results = per_doc_queue[0]
+            # Place each response at its request index so no re-sorting is
+            # needed when the doc is processed.
+            if i >= len(per_doc_results):
+                per_doc_results.extend([None] * (i + 1 - len(per_doc_results)))
+            per_doc_results[i] = resp
+
+    # Unpack results and return control to Task
     vals = collections.defaultdict(list)
     example_logger = logging.getLogger("examples")
-    for (task_template_key, doc_id), per_doc_requests in process_response_queue.items():
-        per_doc_requests.sort(key=lambda x: x[0])
-        per_doc_results = [x[1] for x in per_doc_requests]
-        fewshot_logging_info = [x[2] for x in per_doc_requests][0]
-
+    # Skip building and serializing examples nobody will see.
+    log_examples = example_logger.isEnabledFor(logging.INFO)
+    logging_infos = {key: task.get_logging_info() for key, task in task_dict.items()}
+    for (task_template_key, doc_id), per_doc_queue in process_response_queue.items():
+        per_doc_results, fewshot_logging_info = per_doc_queue
         task = task_dict[task_template_key]
         doc = docs[(task_template_key, doc_id)]
 
@@ -244,12 +248,11 @@ def evaluate(
         if task.save_examples:
             metrics, example = output
             example.update(fewshot_logging_info)
-            example.update(task.get_logging_info())
-            example_logger.info(json.dumps(example))
         else:
             metrics = output
             example = fewshot_logging_info
-            example.update(task.get_logging_info())
+        if log_examples:
+            example.update(logging_infos[task_template_key])
             example_logger.info(json.dumps(example))
 
         for metric, value in metrics.items():
@@ -257,6 +260,7 @@ def evaluate(
 
     # Aggregate results
     metric_results = []
+    aggregations = {key: task.aggregation() for key, task in task_dict.items()}
     for (task_template_key, metric), items in vals.items():
         task_name, prompt_name = lm_eval.tasks._split_task_template_key(
             task_template_key
@@ -264,27 +268,29 @@ def evaluate(
 
         results[task_template_key]["task_name"] = task_name
         results[task_template_key]["prompt_name"] = prompt_name
-        task = task_dict[task_template_key]
-        results[task_template_key][metric] = task.aggregation()[metric](items)
+        aggregation = aggregations[task_template_key][metric]
+        value = aggregation(items)
+        results[task_template_key][metric] = value
 
         _metric_results = {
             "task_name": task_name,
             "prompt_name": prompt_name,
-            metric: task.aggregation()[metric](items),
-            **task.get_logging_info(),
+            metric: value,
+            **logging_infos[task_template_key],
         }
         # NOTE: bleu, chrf, ter seem to be really expensive to bootstrap
         # so we run them less iterations.
         # TODO: Find an efficient work around.
         stderr = lm_eval.api.metric.stderr_for_metric(
-            metric=task.aggregation()[metric],
+            metric=aggregation,
             bootstrap_iters=min(bootstrap_iters, 1000)
             if metric in ["bleu", "chrf", "ter"]
             else bootstrap_iters,
         )
         if stderr is not None:
-            results[task_template_key][metric + "_stderr"] = stderr(items)
-            _metric_results[metric + "_stderr"] = stderr(items)
+            stderr_value = stderr(items)
+            results[task_template_key][metric + "_stderr"] = stderr_value
+            _metric_results[metric + "_stderr"] = stderr_value
         metric_results.append(_metric_results)
 
     return {
@@ -297,6 +303,173 @@ def evaluate(
     }
 
 
+def _construct_requests(
+    task_dict: Dict[str, Task],
+    *,
+    num_fewshot: int,
+    rng: np.random.Generator,
+    limit: Optional[int] = None,
+) -> Tuple[dict, dict, dict]:
+    """Builds the few-shot contexts for every task doc and collects the
+    language model requests by request type.
+
+    Returns:
+        A tuple of (requests, requests_origin, docs):
+            requests (dict):
+                Maps each request type to a list of `Request`s.
+            requests_origin (dict):
+                Maps each request type to a list of tuples that identifies the
+                task doc each request in `requests` originates from.
+            docs (dict):
+                Maps each `(task_template_key, doc_id)` pair to its doc.
+    """
+    requests = collections.defaultdict(list)
+    requests_origin = collections.defaultdict(list)
+
+    # TODO: We need unit tests & sanity checks or something to ensure that the return of `validation_docs` is stable
+    docs = {}
+
+    # Build contexts and collect language model requests.
+    for task_template_key, task in task_dict.items():
+        task_docs = task.evaluation_docs()
+
+        logger.info(f"\n» Assigning unique IDs to '{task_template_key}' docs")
+        # NOTE: Any existing `doc_id` field is replaced.
+        if "doc_id" in task_docs.column_names:
+            task_docs = task_docs.remove_columns("doc_id")
+        task_docs = task_docs.add_column("doc_id", range(len(task_docs)))
+
+        logger.info(f"\n» Filtering invalid docs from '{task_template_key}'")
+        task_docs = task_docs.filter(lambda d: not task.invalid_doc_for_prompt(d))
+        task_docs = task_docs.shuffle(generator=rng)
+
+        if limit is not None:
+            task_docs = task_docs.select(range(min(limit, len(task_docs))))
+
+        logger.info(f"\n» Constructing '{task_template_key}' contexts and requests")
+        for doc_id, doc in enumerate(tqdm(task_docs)):
+            docs[(task_template_key, doc_id)] = doc
+            ctx, fewshotex_logging_info = task.fewshot_context(
+                doc=doc,
+                num_fewshot=num_fewshot,
+                rng=rng,
+            )
+            fewshotex_logging_info["doc_id"] = doc["doc_id"]
+            args = {"num_fewshot": num_fewshot}
+            reqs = task.construct_requests(doc, ctx, args)
+            if not isinstance(reqs, (list, tuple)):
+                reqs = [reqs]
+            for i, req in enumerate(reqs):
+                requests[req.request_type].append(req)
+                # i: Index in requests for a single task instance
+                # doc_id: Unique id that we can get back to a doc using `docs`
+                requests_origin[req.request_type].append(
+                    (i, task_template_key, doc, doc_id, fewshotex_logging_info)
+                )
+
+    return requests, requests_origin, docs
+
+
+def _get_requests_cache_key(
+    task_dict: Dict[str, Task],
+    *,
+    num_fewshot: int,
+    seed: int,
+    limit: Optional[int] = None,
+) -> str:
+    """Returns a hash identifying the requests built by `_construct_requests`.
+
+    NOTE: Requests are built from untokenized strings so the key does not
+    depend on the model; the same cached requests are shared across models.
+    """
+    task_keys = []
+    for task_template_key, task in task_dict.items():
+        eval_docs = task.evaluation_docs()
+        fewshot_docs = task.fewshot_docs() if num_fewshot > 0 else None
+        task_keys.append(
+            {
+                "task_template_key": task_template_key,
+                "task_class": type(task).__qualname__,
+                "version": task.VERSION,
+                "source": _get_task_source_hash(task),
+                "logging_info": task.get_logging_info(),
+                "prompt_template": _get_template_definition(
+                    getattr(task, "prompt_template", None)
+                ),
+                "example_separator": getattr(task, "example_separator", None),
+                "text_target_separator": getattr(task, "text_target_separator", None),
+                "eval_docs": getattr(eval_docs, "_fingerprint", None),
+                "fewshot_docs": getattr(fewshot_docs, "_fingerprint", None),
+            }
+        )
+    data = json.dumps(
+        [task_keys, _get_promptsource_version(), num_fewshot, seed, limit],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _get_template_definition(template) -> Optional[dict]:
+    """Returns the full definition of a `promptsource` template (jinja,
+    `answer_choices`, metadata, ...) so that any edit to it invalidates cached
+    requests, including doc-dependent answer choices that are not part of the
+    task's logging info.
+    """
+    if template is None:
+        return None
+    definition = dict(vars(template))
+    metadata = definition.get("metadata")
+    if hasattr(metadata, "__dict__"):
+        definition["metadata"] = dict(vars(metadata))
+    return definition
+
+
+def _get_promptsource_version() -> Optional[str]:
+    """Returns the installed `promptsource` version; templates are rendered by
+    `promptsource` so its code also determines the cached requests.
+    """
+    try:
+        return importlib.metadata.version("promptsource")
+    except importlib.metadata.PackageNotFoundError:
+        return getattr(promptsource, "__version__", None)
+
+
+def _get_task_source_hash(task: Task) -> str:
+    """Returns a hash of the source code of the modules that define `task`'s
+    class and its base classes, so that edits to how prompts and requests are
+    built invalidate cached requests even without a `VERSION` bump.
+    """
+    source_hash = hashlib.sha256()
+    modules = dict.fromkeys(cls.__module__ for cls in type(task).__mro__)
+    for module_name in modules:
+        try:
+            source = inspect.getsource(sys.modules[module_name])
+        except (KeyError, OSError, TypeError):
+            # Built-in modules and code without a source file (e.g. defined
+            # interactively) have no source to hash.
+            continue
+        source_hash.update(source.encode("utf-8"))
+    return source_hash.hexdigest()
+
+
+def _save_requests_cache(path: str, requests: tuple):
+    """Pickles `requests` to `path`. The pickle is written to a temporary file
+    first and then moved into place so that an interrupted run cannot leave a
+    truncated cache file behind.
+    """
+    cache_dir = os.path.dirname(path) or "."
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(requests, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 def make_table(results: dict) -> str:
     """Returns a markdown table from an evaluation results `dict`.
 
@@ -1,16 +1,23 @@
+import logging
 import math
 import torch
-import torch.nn.functional as F
 import transformers
 from typing import List, Mapping, NewType, Optional, Tuple, Union
-from tqdm import tqdm
+from tqdm.auto import tqdm
 
 from lm_eval.api import utils
 from lm_eval.api.model import TokenLM, TokenSequence
 
 
+logger = logging.getLogger(__name__)
+
+
 _DeviceMapping = NewType("DeviceMapping", Mapping[str, Union[int, str, torch.device]])
 
+# Attention implementations from fastest to slowest. A requested implementation
+# that the model (or environment) does not support falls back to the next one.
+_ATTN_IMPLEMENTATIONS = ["flash_attention_2", "sdpa", "eager"]
+
 
 def _get_accelerate_args(
     device_map_option: Optional[str] = "auto",
@@ -51,6 +58,57 @@ def _get_dtype(
     return _torch_dtype
 
 
+def _get_autocast_dtype(
+    autocast_dtype: Optional[Union[str, torch.dtype]] = None
+) -> Optional[torch.dtype]:
+    """Converts `autocast_dtype` to a floating point `torch.dtype`, raising
+    early on values that `torch.autocast` would only reject mid-evaluation.
+    """
+    if autocast_dtype is None:
+        return None
+    _torch_dtype = autocast_dtype
+    if isinstance(autocast_dtype, str):
+        _torch_dtype = getattr(torch, autocast_dtype, None)
+    if not isinstance(_torch_dtype, torch.dtype) or not _torch_dtype.is_floating_point:
+        raise ValueError(
+            f"Invalid `autocast_dtype`: `{autocast_dtype}`. Use a floating point "
+            "dtype such as `bfloat16` or `float16`."
+        )
+    return _torch_dtype
+
+
+def _get_quantization_config(
+    quantization: Optional[str] = None,
+) -> Optional[transformers.BitsAndBytesConfig]:
+    """Returns the `bitsandbytes` config for the `quantization` option, if any."""
+    if quantization is None:
+        return None
+    elif quantization == "int8":
+        # LLM.int8(): 8-bit weights with fp16 outlier features.
+        return transformers.BitsAndBytesConfig(
+            load_in_8bit=True, llm_int8_threshold=6.0
+        )
+    elif quantization == "nf4":
+        return transformers.BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+        )
+    else:
+        raise ValueError(
+            f"Unknown quantization option: `{quantization}`. Use `int8` or `nf4`."
+        )
+
+
+def _is_attn_implementation_error(error: Exception) -> bool:
+    """Returns whether `error` was raised by `transformers` because the model
+    (or environment) does not support the requested attention implementation,
+    e.g. a model without Flash Attention 2 support or a missing `flash-attn`.
+    """
+    message = str(error).lower()
+    return any(name in message for name in ("attention", "attn", "flash", "sdpa"))
+
+
 class HuggingFaceAutoLM(TokenLM):
     AUTO_CONFIG_CLASS: transformers.AutoConfig = transformers.AutoConfig
     AUTO_TOKENIZER_CLASS: transformers.AutoTokenizer = transformers.AutoTokenizer
@@ -77,6 +135,10 @@ class HuggingFaceAutoLM(TokenLM):
         offload_folder: Optional[str] = "./offload",
         dtype: Optional[Union[str, torch.dtype]] = None,
         device: Optional[Union[int, str]] = "cuda",
+        use_torch_compile: Optional[bool] = False,
+        quantization: Optional[str] = None,
+        autocast_dtype: Optional[Union[str, torch.dtype]] = None,
+        attn_implementation: Optional[str] = None,
     ):
         """Initializes a HuggingFace `AutoModel` and `AutoTokenizer` for evaluation.
 
@@ -125,12 +187,40 @@ class HuggingFaceAutoLM(TokenLM):
                 Converts the model weights to `dtype`, if specified. Strings get
                 converted to `torch.dtype` objects (e.g. `float16` -> `torch.float16`).
                 Use `dtype="auto"` to derive the type from the model’s weights.
+            use_torch_compile (bool, optional, defaults to False):
+                If True, compiles the model's forward pass with `torch.compile`
+                (requires PyTorch >= 2.0). The first batches of each new input
+                shape are slower while they are compiled, so batches are padded
+                to a few fixed bucket lengths to limit recompilation. Only
+                scoring uses the compiled model; generation runs eagerly.
+            quantization (str, optional, defaults to None):
+                Loads the model weights quantized with `bitsandbytes`.
+                Options:
+                    "int8": LLM.int8() 8-bit weights.
+                    "nf4": 4-bit NormalFloat weights with bfloat16 compute.
+                Quantized models are placed with `accelerate` (as if
+                `use_accelerate=True`) and are not compiled.
+            autocast_dtype (Union[str, torch.dtype], optional, defaults to None):
+                If specified, runs the model's forward passes and generation
+                under `torch.autocast` with this dtype (e.g. `bfloat16`) while
+                keeping the weights in `dtype`. Log-probabilities are still
+                reduced in float32.
+            attn_implementation (str, optional, defaults to None):
+                The attention implementation to load the model with.
+                Options: "flash_attention_2", "sdpa", "eager".
+                If the model does not support the requested implementation, the
+                next one in that order is tried instead. Flash Attention 2
+                requires the `flash-attn` package and a `float16` or `bfloat16`
+                `dtype`. If None, the `transformers` default is used.
         """
         super().__init__()
 
         assert isinstance(pretrained, str)
         assert isinstance(device, str)
         assert isinstance(batch_size, int)
+        assert (
+            attn_implementation is None or attn_implementation in _ATTN_IMPLEMENTATIONS
+        ), f"`attn_implementation` must be one of {_ATTN_IMPLEMENTATIONS}."
         if (
             add_special_tokens is not None
             and self.AUTO_MODEL_CLASS is transformers.AutoModelForCausalLM
@@ -144,9 +234,22 @@ class HuggingFaceAutoLM(TokenLM):
                 not add_special_tokens
             ), "Evaluating causal models with `add_special_tokens=True` is currently not supported."
 
+        quantization_config = _get_quantization_config(quantization)
+        if quantization_config is not None:
+            # Quantized weights are placed on their devices as they are loaded
+            # and cannot be moved with `.to()` afterwards.
+            use_accelerate = True
+            if use_torch_compile:
+                logger.warning(
+                    "`torch.compile` does not support quantized models; "
+                    "ignoring `use_torch_compile=True`."
+                )
+                use_torch_compile = False
+
         self._batch_size = batch_size  # TODO: Adaptive batch size
+        self._use_torch_compile = use_torch_compile
+        self._autocast_dtype = _get_autocast_dtype(autocast_dtype)
         self._max_gen_toks = max_gen_toks
-        self._max_length = max_length
         self._config = self.AUTO_CONFIG_CLASS.from_pretrained(
             pretrained,
             revision=revision + ("/" + subfolder if subfolder is not None else ""),
@@ -159,6 +262,8 @@ class HuggingFaceAutoLM(TokenLM):
             subfolder=subfolder,
             tokenizer=tokenizer,
         )
+        # Resolve the max length once since it is read in hot loops.
+        self._max_length = self._resolve_max_length(max_length)
         self.tokenizer.model_max_length = self.max_length
 
         accelerate_kwargs = {}
@@ -174,20 +279,47 @@ class HuggingFaceAutoLM(TokenLM):
             revision=revision,
             subfolder=subfolder,
             torch_dtype=_get_dtype(dtype, self._config),
+            quantization_config=quantization_config,
+            attn_implementation=attn_implementation,
             **accelerate_kwargs,
         )
         self.model.eval()
-        torch.set_grad_enabled(False)
-
-        self._device = device
-        if use_accelerate and "lm_head" in self.model.hf_device_map:
-            # `accelerate` can place `lm_head` weights on a different device than
-            # the user specified one so we force `self._device` to be the same as
-            # `lm_head`'s.
-            self._device = self.model.hf_device_map["lm_head"]
-        if not use_accelerate:
+
+        self._device = torch.device(device)
+        if use_accelerate:
+            # `accelerate` can place the weights on different devices than the
+            # user specified one so we force `self._device` to be the same as
+            # `lm_head`'s. Models without a separate `lm_head` entry (e.g. with
+            # tied embeddings) fall back to the first device in the map, which
+            # holds the input embeddings. Weights offloaded to `offload_folder`
+            # are mapped to "disk", which is not a torch device, and are skipped.
+            device_map = self.model.hf_device_map
+            devices = [
+                device
+                for device in [device_map.get("lm_head"), *device_map.values()]
+                if device is not None and device != "disk"
+            ]
+            if not devices:
+                raise ValueError(
+                    "`accelerate` offloaded every module of the model to disk; "
+                    "increase `max_memory_per_gpu` or `max_cpu_memory`."
+                )
+            self._device = torch.device(devices[0])
+        else:
             self.model.to(self._device)
 
+        # The callable used by `_model_call` to score batches.
+        self._model_forward = self.model
+        if use_torch_compile:
+            assert hasattr(
+                torch, "compile"
+            ), "`use_torch_compile=True` requires PyTorch 2.0 or later."
+            # Only scoring runs the compiled model: its inputs are padded to a
+            # few bucket lengths. `generate` keeps the eager forward since every
+            # decoding step has a new KV-cache length and would recompile (and
+            # record a new CUDA graph).
+            self._model_forward = torch.compile(self.model, mode="reduce-overhead")
+
     def _create_auto_model(
         self,
         *,
@@ -198,17 +330,42 @@ class HuggingFaceAutoLM(TokenLM):
         max_memory: Optional[dict] = None,
         offload_folder: Optional[str] = None,
         torch_dtype: Optional[Union[str, torch.dtype]] = None,
+        quantization_config: Optional[transformers.BitsAndBytesConfig] = None,
+        attn_implementation: Optional[str] = None,
     ) -> transformers.AutoModel:
         """Returns a pre-trained pytorch model from a pre-trained model configuration."""
-        model = self.AUTO_MODEL_CLASS.from_pretrained(
-            pretrained,
+        model_kwargs = dict(
             revision=revision + ("/" + subfolder if subfolder is not None else ""),
             device_map=device_map,
             max_memory=max_memory,
             offload_folder=offload_folder,
             torch_dtype=torch_dtype,
+            quantization_config=quantization_config,
+        )
+        if attn_implementation is None:
+            return self.AUTO_MODEL_CLASS.from_pretrained(pretrained, **model_kwargs)
+
+        implementations = _ATTN_IMPLEMENTATIONS[
+            _ATTN_IMPLEMENTATIONS.index(attn_implementation) :
+        ]
+        for implementation, fallback in zip(implementations, implementations[1:]):
+            try:
+                return self.AUTO_MODEL_CLASS.from_pretrained(
+                    pretrained, attn_implementation=implementation, **model_kwargs
+                )
+            except (ImportError, ValueError) as e:
+                # `transformers` raises these while validating the attention
+                # implementation, before any weights are loaded. Anything else
+                # (e.g. a bad `device_map`) would fail again with every fallback.
+                if not _is_attn_implementation_error(e):
+                    raise
+                logger.warning(
+                    f"Could not load the model with `attn_implementation="
+                    f"{implementation}` ({e}); falling back to `{fallback}`."
+                )
+        return self.AUTO_MODEL_CLASS.from_pretrained(
+            pretrained, attn_implementation=implementations[-1], **model_kwargs
         )
-        return model
 
     def _create_auto_tokenizer(
         self,
@@ -223,6 +380,13 @@ class HuggingFaceAutoLM(TokenLM):
             pretrained if tokenizer is None else tokenizer,
             revision=revision + ("/" + subfolder if subfolder is not None else ""),
         )
+        if not tokenizer.is_fast:
+            # Batched encoding is much slower with the pure Python tokenizers,
+            # which `from_pretrained` falls back to when no fast one exists.
+            logger.warning(
+                f"No fast tokenizer is available for `{tokenizer.name_or_path}`; "
+                "tokenization will be slower."
+            )
         tokenizer.pad_token = tokenizer.eos_token
         return tokenizer
 
@@ -261,7 +425,12 @@ class HuggingFaceAutoLM(TokenLM):
 
     @property
     def max_length(self) -> int:
-        """Return the maximum sequence length of the model.
+        """Return the maximum sequence length of the model."""
+        return self._max_length
+
+    def _resolve_max_length(self, max_length: Optional[int] = None) -> int:
+        """Returns `max_length` if specified, otherwise the maximum sequence
+        length found in the model config or tokenizer.
         NOTE: Different model configurations have different max sequence length
         attribute names.
             - n_positions: (CTRLConfig)
@@ -270,8 +439,8 @@ class HuggingFaceAutoLM(TokenLM):
         NOTE: For relative position encoded models you should specify the max
         sequence length of the model in the constructor via `max_length`.
         """
-        if self._max_length is not None:
-            return self._max_length
+        if max_length is not None:
+            return max_length
         # Try to get the sequence length from the model config.
         seqlen_config_attrs = ("n_positions", "max_position_embeddings", "n_ctx")
         for attr in seqlen_config_attrs:
@@ -287,36 +456,90 @@ class HuggingFaceAutoLM(TokenLM):
         return self._batch_size  # * gpus
 
     @property
-    def device(self) -> Union[int, str, torch.device]:
+    def device(self) -> torch.device:
         return self._device
 
-    def tok_encode(self, string: str) -> TokenSequence:
-        # TODO: Merge `tok_encode_batch` here.
-        return self.tokenizer.encode(string, add_special_tokens=self.add_special_tokens)
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Copies `tensor` to the model's device without blocking the host.
+        CPU tensors are page-locked first when the model is on a CUDA device so
+        that the copy can overlap with work already queued on the device.
+        """
+        if self.device.type == "cuda" and tensor.device.type == "cpu":
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def _autocast(self) -> torch.autocast:
+        """Returns the `torch.autocast` context to run the model under. This is
+        a no-op unless an `autocast_dtype` was specified.
+        """
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=self._autocast_dtype,
+            enabled=self._autocast_dtype is not None,
+        )
+
+    def tok_encode(self, string: Union[str, List[str]]) -> TokenSequence:
+        if isinstance(string, str):
+            return self.tok_encode([string])[0]
+        return self.tokenizer(string, add_special_tokens=self.add_special_tokens)[
+            "input_ids"
+        ]
 
     def tok_encode_batch(self, strings: List[str]) -> TokenSequence:
-        return self.tokenizer(
-            strings,
-            padding=True,
-            add_special_tokens=self.add_special_tokens,
+        if not self._use_torch_compile:
+            return self.tokenizer(
+                strings,
+                padding=True,
+                add_special_tokens=self.add_special_tokens,
+                return_tensors="pt",
+            )
+        encodings = self.tokenizer(strings, add_special_tokens=self.add_special_tokens)
+        length = max(len(input_ids) for input_ids in encodings["input_ids"])
+        return self.tokenizer.pad(
+            encodings,
+            padding="max_length",
+            max_length=self._padded_length(length),
             return_tensors="pt",
         )
 
+    def _padded_length(self, length: int) -> int:
+        """Returns the length to pad a batch whose longest sequence has `length`
+        tokens to. With `torch.compile` enabled, lengths are rounded up to the
+        next power of 2 (from 64, capped at `max_length`) so that only a few
+        distinct input shapes get compiled.
+        """
+        if not self._use_torch_compile:
+            return length
+        bucket = 64
+        while bucket < length:
+            bucket *= 2
+        return max(length, min(bucket, self.max_length))
+
     def tok_decode(self, tokens: torch.LongTensor) -> List[str]:
         return self.tokenizer.batch_decode(tokens, skip_special_tokens=True)
 
     def greedy_until(self, requests: List[Tuple[str, dict]]) -> List[str]:
-        def _collate(x):
-            tokens = self.tok_encode(x[0])
-            return len(tokens), x[0]
+        if not requests:
+            return []
 
+        def _collate(x):
+            # Sort by token length so that similarly sized contexts are batched
+            # together and padding is kept to a minimum.
+            return x[1], x[0][0]
+
+        # Tokenize all contexts with one batched call to get their lengths
+        # instead of encoding each one while sorting.
+        lengths = [
+            len(context_enc)
+            for context_enc in self.tok_encode([context for context, _ in requests])
+        ]
         results = []
-        reorder = utils.Reorderer(requests, _collate)
+        reorder = utils.Reorderer(list(zip(requests, lengths)), _collate)
         for chunk in utils.chunks(
             tqdm(reorder.get_reordered(), disable=False), self.batch_size
         ):
-            context = [c[0] for c in chunk]
-            request_args = chunk[0][1]
+            context = [request[0] for request, _ in chunk]
+            request_args = chunk[0][0][1]
             stop_sequences = request_args["stop_sequences"]
             max_generation_length = request_args["max_generation_length"]
             num_fewshot = request_args["num_fewshot"]
@@ -382,11 +605,14 @@ class AutoCausalLM(HuggingFaceAutoLM):
         tokenizer.padding_side = "left"
         return tokenizer
 
+    @torch.inference_mode()
     def _model_call(
         self, inputs: TokenSequence, labels: Optional[TokenSequence] = None
     ) -> TokenSequence:
-        return self.model(inputs)["logits"]
+        with self._autocast():
+            return self._model_forward(inputs)["logits"]
 
+    @torch.inference_mode()
     def _model_generate(
         self,
         inputs: transformers.BatchEncoding,
@@ -399,25 +625,26 @@ class AutoCausalLM(HuggingFaceAutoLM):
         attention_mask = inputs["attention_mask"][
             :, self.max_gen_toks - self.max_length :
         ]
-        input_ids = input_ids.to(self.device)
-        attention_mask = attention_mask.to(self.device)
+        input_ids = self._to_device(input_ids)
+        attention_mask = self._to_device(attention_mask)
 
         stopping_criteria = stop_sequences_criteria(
             self.tokenizer, stop, input_ids.shape[1], input_ids.shape[0]
         )
 
-        generations = self.model.generate(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            # GPT style models require the `generate` `max_length` arg to include the
-            # context length, so we instead set `max_new_tokens` which is the number
-            # of new tokens to generate, excluding the current number of tokens.
-            max_new_tokens=max_tokens,
-            stopping_criteria=stopping_criteria,
-            do_sample=False,
-        )
+        with self._autocast():
+            generations = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                # GPT style models require the `generate` `max_length` arg to include the
+                # context length, so we instead set `max_new_tokens` which is the number
+                # of new tokens to generate, excluding the current number of tokens.
+                max_new_tokens=max_tokens,
+                stopping_criteria=stopping_criteria,
+                do_sample=False,
+            )
         return utils.select_continuation_from_batch_left_padding(
-            generations, max_context_size=inputs["input_ids"].size(1)
+            generations, max_context_size=input_ids.size(1)
         )
 
 
@@ -429,140 +656,206 @@ class AutoSeq2SeqLM(HuggingFaceAutoLM):
 
     AUTO_MODEL_CLASS = transformers.AutoModelForSeq2SeqLM
 
-    @property
-    def max_length(self) -> int:
-        """Return the maximum sequence length of the model.
+    def _resolve_max_length(self, max_length: Optional[int] = None) -> int:
+        """Returns `max_length` if specified, otherwise the default max length.
         TODO: Currently only works for relative position encoded Seq2Seq models.
         """
-        if self._max_length is not None:
-            return self._max_length
+        if max_length is not None:
+            return max_length
         return self._DEFAULT_MAX_LENGTH
 
     def loglikelihood(
         self, requests: List[Tuple[str, str]]
     ) -> List[Tuple[float, bool]]:
-        new_requests = []
-        for chunk in utils.chunks(requests, self.batch_size):
-            context, continuation = zip(*chunk)
+        if not requests:
+            return []
 
-            # Fill empty contexts with the EOT token.
-            context = [
-                f"{self.eot_token}" if len(text) == 0 else text for text in context
-            ]
-            context_enc = self.tok_encode_batch(context)
-            for key in context_enc:
-                context_enc[key] = context_enc[key][:, -self.max_length :]
-
-            # Remove leading whitespace introduced by the default
-            # `text_target_separator` since the context and continuation
-            # will not be concatenated as a single (decoder) input.
-            continuation = [text.lstrip() for text in continuation]
-            continuation_enc = self.tok_encode_batch(list(continuation))
-            for key in continuation_enc:
-                continuation_enc[key] = continuation_enc[key][:, -self.max_length :]
+        def _collate(x):
+            # Sort by descending token length so that similarly sized requests
+            # are batched together and padding is kept to a minimum.
+            _, context_enc, continuation_enc = x
+            return -(len(context_enc) + len(continuation_enc)), x[0]
+
+        def _pad(encodings):
+            length = self._padded_length(max(map(len, encodings)))
+            return self.tokenizer.pad(
+                {"input_ids": encodings},
+                padding="max_length",
+                max_length=length,
+                return_tensors="pt",
+            )
 
+        contexts, continuations = zip(*requests)
+        # Fill empty contexts with the EOT token.
+        contexts = [
+            f"{self.eot_token}" if len(text) == 0 else text for text in contexts
+        ]
+        # Remove leading whitespace introduced by the default
+        # `text_target_separator` since the context and continuation
+        # will not be concatenated as a single (decoder) input.
+        continuations = [text.lstrip() for text in continuations]
+        # Encode every string once, without padding; the lengths are used to
+        # sort the requests and each batch is then padded on its own.
+        contexts_enc = [enc[-self.max_length :] for enc in self.tok_encode(contexts)]
+        continuations_enc = [
+            enc[-self.max_length :] for enc in self.tok_encode(continuations)
+        ]
+        reorder = utils.Reorderer(
+            list(zip(zip(contexts, continuations), contexts_enc, continuations_enc)),
+            _collate,
+        )
+
+        new_requests = []
+        for chunk in utils.chunks(reorder.get_reordered(), self.batch_size):
+            cache_keys, context_enc, continuation_enc = zip(*chunk)
+            context, continuation = zip(*cache_keys)
             new_requests.append(
-                ((context, continuation), context_enc, continuation_enc)
+                ((context, continuation), _pad(context_enc), _pad(continuation_enc))
             )
-        return self._loglikelihood_tokens(new_requests)
+        return reorder.get_original(self._loglikelihood_tokens(new_requests))
 
     def loglikelihood_rolling(self, requests: List[Tuple[str, str]]) -> List[float]:
-        loglikelihoods = []
-        for (string,) in tqdm(requests):
-            rolling_token_windows = list(
-                map(
-                    utils.make_disjoint_window,
-                    utils.get_rolling_token_windows(
-                        token_list=self.tok_encode(string),
-                        prefix_token=self.eot_token_id,
-                        max_seq_len=self.max_length,
-                        context_len=1,
-                    ),
-                )
-            )
-            contexts, conts = utils.split_and_pad_windows(
-                rolling_token_windows,
-                pad_token_id=self.eot_token_id,
-                max_seq_len=self.max_length,
-            )
+        if not requests:
+            return []
+        rolling_token_windows, window_string_ids = self._rolling_token_windows(requests)
+        loglikelihoods = [0.0] * len(requests)
+        for chunk in utils.chunks(
+            tqdm(
+                list(zip(window_string_ids, rolling_token_windows)),
+                mininterval=1.0,
+                miniters=max(1, len(rolling_token_windows) // 100),
+            ),
+            self.batch_size,
+        ):
+            string_ids, windows = zip(*chunk)
+            contexts, conts = zip(*windows)
+            # Pad the windows to the longest context and continuation in the
+            # batch with EOT tokens, which are masked out below. Windows that
+            # predict a single token have an empty context, so contexts get at
+            # least one (padding) token.
+            context_length = self._padded_length(max(1, max(map(len, contexts))))
+            contexts = [
+                context + [self.eot_token_id] * (context_length - len(context))
+                for context in contexts
+            ]
+            cont_length = self._padded_length(max(map(len, conts)))
+            conts = [
+                cont + [self.eot_token_id] * (cont_length - len(cont)) for cont in conts
+            ]
             # Manually create BatchEncoding tensors with attention masks as
             # expected by `self._model_call` in `self._loglikelihood_tokens`.
-            contexts_enc = torch.Tensor(contexts).long()
+            contexts_enc = torch.as_tensor(contexts, dtype=torch.long)
+            contexts_mask = contexts_enc.ne(self.eot_token_id).long()
+            # The first context token is never padding (it is the EOT prefix
+            # token in the first window); masking out every encoder position
+            # yields NaNs in half precision.
+            contexts_mask[:, 0] = 1
             contexts_enc = transformers.tokenization_utils_base.BatchEncoding(
-                {
-                    "input_ids": contexts_enc,
-                    "attention_mask": (contexts_enc != self.eot_token_id).long(),
-                }
+                {"input_ids": contexts_enc, "attention_mask": contexts_mask}
             )
-            conts_enc = torch.Tensor(conts).long()
+            conts_enc = torch.as_tensor(conts, dtype=torch.long)
             conts_enc = transformers.tokenization_utils_base.BatchEncoding(
                 {
                     "input_ids": conts_enc,
-                    "attention_mask": (conts_enc != self.eot_token_id).long(),
+                    "attention_mask": conts_enc.ne(self.eot_token_id).long(),
                 }
             )
-            # TODO: Extract out this call so it only gets called once and also
-            # somehow figure out partial caching for.
-            rolling_token_windows_request = [
-                ((contexts, conts), contexts_enc, conts_enc)
-            ]
-            string_nll = self._loglikelihood_tokens(
-                rolling_token_windows_request, disable_tqdm=True
+            # TODO: Figure out partial caching for the rolling windows.
+            rolling_token_windows_request = [(None, contexts_enc, conts_enc)]
+            window_nlls = self._loglikelihood_tokens(
+                rolling_token_windows_request, disable_tqdm=True, compute_greedy=False
             )
-            string_nll = [x[0] for x in string_nll]  # discard is_greedy
-            string_nll = sum(string_nll)
-            loglikelihoods.append(string_nll)
+            # Discard `is_greedy`
+            for string_id, (window_nll, _) in zip(string_ids, window_nlls):
+                loglikelihoods[string_id] += window_nll
         return loglikelihoods
 
+    @torch.inference_mode()
     def _loglikelihood_tokens(
         self,
-        requests: List[Tuple[Tuple[str, str], TokenSequence, TokenSequence]],
+        requests: List[
+            Tuple[Optional[Tuple[str, str]], TokenSequence, TokenSequence]
+        ],
         disable_tqdm: Optional[bool] = False,
-    ) -> List[Tuple[float, bool]]:
+        compute_greedy: Optional[bool] = True,
+    ) -> List[Tuple[float, Optional[bool]]]:
         results = []
         for chunk in tqdm(
             requests, total=math.ceil(len(requests)), disable=disable_tqdm
         ):
             cache_keys, inputs_tokens, targets_tokens = chunk
-            inputs_tokens = inputs_tokens.to(self.device)
-            targets_tokens = targets_tokens.to(self.device)
+            inputs_tokens = transformers.BatchEncoding(
+                {k: self._to_device(v) for k, v in inputs_tokens.items()}
+            )
+            targets_tokens = transformers.BatchEncoding(
+                {k: self._to_device(v) for k, v in targets_tokens.items()}
+            )
             outputs = self._model_call(inputs=inputs_tokens, labels=targets_tokens)
-            log_softmaxes = F.log_softmax(outputs.logits, dim=-1)
-
-            output_iterator = zip(
-                zip(cache_keys[0], cache_keys[1]),
-                log_softmaxes,
-                targets_tokens["input_ids"],
-                targets_tokens["attention_mask"],
+            logits = outputs.logits
+
+            # Score every target in the batch at once: each row only counts its
+            # first `attention_mask.sum()` tokens.
+            target_ids = targets_tokens["input_ids"]
+            lengths = targets_tokens["attention_mask"].sum(dim=-1, keepdim=True)
+            target_mask = (
+                torch.arange(target_ids.shape[1], device=target_ids.device) < lengths
             )
-            for cache_key, log_softmax, target_tokens, target_mask in output_iterator:
-                length = target_mask.sum()
-                log_softmax = log_softmax[:length]
-                target_tokens = target_tokens[:length]
-                greedy_tokens = log_softmax.argmax(dim=-1)
-                max_equal = (greedy_tokens == target_tokens).all()
-                target_logits = torch.gather(
-                    log_softmax, 1, target_tokens.unsqueeze(-1)
-                ).squeeze(-1)
-                answer = (float(target_logits.sum()), bool(max_equal))
+            # log_softmax(x)_i = x_i - logsumexp(x): only gather the target logits
+            # instead of materializing the full [batch, seq, vocab] log-probs.
+            # NOTE: The normalizers are reduced in float32 a few positions at a
+            # time, so half precision logits are never rounded before the sum.
+            target_logits = torch.gather(logits, 2, target_ids.unsqueeze(-1)).float()
+            target_logits = target_logits.squeeze(-1) - utils.logsumexp_float32(logits)
+            target_logits = target_logits.masked_fill(~target_mask, 0.0).sum(dim=-1)
+            if compute_greedy:
+                greedy_tokens = logits.argmax(dim=-1)
+                max_equals = ((greedy_tokens == target_ids) | ~target_mask).all(dim=-1)
+                # Read both results back with a single device-to-host copy once
+                # all of the batch's work has been queued.
+                target_logits, max_equals = torch.stack(
+                    [target_logits, max_equals.float()]
+                ).tolist()
+                max_equals = [bool(max_equal) for max_equal in max_equals]
+            else:
+                target_logits = target_logits.tolist()
+                max_equals = [None] * len(target_logits)
+
+            # Batches without cache keys (e.g. rolling windows) are not cached.
+            if cache_keys is None:
+                cache_keys = [None] * len(target_logits)
+            else:
+                cache_keys = zip(cache_keys[0], cache_keys[1])
+            output_iterator = zip(cache_keys, target_logits, max_equals)
+            for cache_key, target_logit, max_equal in output_iterator:
+                answer = (target_logit, max_equal)
                 results.append(answer)
                 if cache_key is not None:
                     self.cache_hook.add_partial("loglikelihood", cache_key, answer)
         return results
 
+    @torch.inference_mode()
     def _model_call(
         self, inputs: TokenSequence, labels: Optional[TokenSequence] = None
     ) -> TokenSequence:
-        return self.model(**inputs, labels=labels["input_ids"])
+        # Pass the shifted decoder inputs instead of `labels` so that the model
+        # does not also compute a cross-entropy loss over the full logits.
+        decoder_input_ids = self.model.prepare_decoder_input_ids_from_labels(
+            labels=labels["input_ids"]
+        )
+        with self._autocast():
+            return self._model_forward(**inputs, decoder_input_ids=decoder_input_ids)
 
+    @torch.inference_mode()
     def _model_generate(
         self,
         inputs: transformers.BatchEncoding,
         max_tokens: int,
         stop: Optional[List[str]] = None,
     ) -> TokenSequence:
-        input_ids = inputs["input_ids"][:, -self.max_length :].to(self.device)
-        attention_mask = inputs["attention_mask"][:, -self.max_length :].to(self.device)
+        input_ids = self._to_device(inputs["input_ids"][:, -self.max_length :])
+        attention_mask = self._to_device(
+            inputs["attention_mask"][:, -self.max_length :]
+        )
 
         # Generate one token to calculate the number of start tokens prepended to decoder_input_ids
         # (leaving this here in case the below assumption is violated in the future)
@@ -578,44 +871,54 @@ class AutoSeq2SeqLM(HuggingFaceAutoLM):
             self.tokenizer, stop, 1, input_ids.shape[0]
         )
 
-        generations = self.model.generate(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            max_new_tokens=max_tokens,
-            stopping_criteria=stopping_criteria,
-            do_sample=False,
-        )
+        with self._autocast():
+            generations = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_tokens,
+                stopping_criteria=stopping_criteria,
+                do_sample=False,
+            )
         return generations
 
 
 class MultiTokenEOSCriteria(transformers.StoppingCriteria):
-    """Criteria to stop on the specified multi-token sequence."""
+    """Criteria to stop once every sequence in the batch has generated any of
+    the specified multi-token stop sequences.
+    """
 
     def __init__(
         self,
-        sequence: str,
+        sequences: List[str],
         tokenizer: transformers.PreTrainedTokenizer,
         initial_decoder_input_length: int,
         batch_size: int,
     ):
         self.initial_decoder_input_length = initial_decoder_input_length
         self.done_tracker = [False] * batch_size
-        self.sequence = sequence
-        self.sequence_ids = tokenizer.encode(sequence, add_special_tokens=False)
-        self.sequence_id_len = len(self.sequence_ids)
+        self.sequences = sequences
+        # Look back far enough to see the longest of the stop sequences.
+        self.lookback_len = max(
+            len(tokenizer.encode(sequence, add_special_tokens=False))
+            for sequence in sequences
+        )
         self.tokenizer = tokenizer
 
     def __call__(self, input_ids, scores, **kwargs) -> bool:
-        # For efficiency, we compare the last n tokens where n is the number of tokens in the stop_sequence
-        lookback_ids_batch = input_ids[:, self.initial_decoder_input_length :][
-            :, -self.sequence_id_len :
+        # Only decode the rows that have not generated a stop sequence yet.
+        pending = [i for i, done in enumerate(self.done_tracker) if not done]
+        # For efficiency, we only decode the last n tokens where n is the number
+        # of tokens in the longest stop sequence, once for all stop sequences.
+        lookback_ids_batch = input_ids[pending, self.initial_decoder_input_length :][
+            :, -self.lookback_len :
         ]
 
         lookback_tokens_batch = self.tokenizer.batch_decode(lookback_ids_batch)
 
-        for i, done in enumerate(self.done_tracker):
-            if not done:
-                self.done_tracker[i] = self.sequence in lookback_tokens_batch[i]
+        for i, lookback_tokens in zip(pending, lookback_tokens_batch):
+            self.done_tracker[i] = any(
+                sequence in lookback_tokens for sequence in self.sequences
+            )
         return False not in self.done_tracker
 
 
@@ -625,13 +928,12 @@ def stop_sequences_criteria(
     initial_decoder_input_length: int,
     batch_size: int,
 ) -> transformers.StoppingCriteriaList:
+    if not stop_sequences:
+        return transformers.StoppingCriteriaList()
     return transformers.StoppingCriteriaList(
         [
-            *[
-                MultiTokenEOSCriteria(
-                    sequence, tokenizer, initial_decoder_input_length, batch_size
-                )
-                for sequence in stop_sequences
-            ],
+            MultiTokenEOSCriteria(
+                stop_sequences, tokenizer, initial_decoder_input_length, batch_size
+            )
         ]
     )
@@ -121,8 +121,10 @@ class OpenAICompletionsLM(TokenLM):
     def device(self) -> str:
         raise NotImplementedError()
 
-    def tok_encode(self, string: str):
-        return self.tokenizer.encode(string, add_special_tokens=False)
+    def tok_encode(self, string: Union[str, List[str]]):
+        if isinstance(string, str):
+            return self.tokenizer.encode(string, add_special_tokens=False)
+        return self.tokenizer(string, add_special_tokens=False)["input_ids"]
 
     def tok_decode(self, tokens: Iterable[int]) -> List[str]:
         return self.tokenizer.decode(tokens)
@@ -131,7 +133,10 @@ class OpenAICompletionsLM(TokenLM):
         self,
         requests: List[Union[Tuple[str, str], TokenSequence, TokenSequence]],
         disable_tqdm: Optional[bool] = False,
+        compute_greedy: Optional[bool] = True,
     ) -> List[Tuple[float, bool]]:
+        # NOTE: `compute_greedy` is ignored; the greedy check comes for free
+        # from the `top_logprobs` the API returns.
         def _collate(x):
             # this doesn't efficiently handle last-token differences yet, but those are kinda annoying because
             # it's not guaranteed that the 100 or so logprobs we get to see actually contain all the continuations
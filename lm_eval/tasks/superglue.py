@@ -263,7 +263,10 @@ class SGWinogradSchemaChallenge(PromptSourceTask):
 
     def training_docs(self):
         if self.has_training_docs():
-            return self.dataset["train"].filter(lambda d: d["label"])
+            # Filter once; this is called for every few-shot context.
+            if self._training_docs is None:
+                self._training_docs = self.dataset["train"].filter(lambda d: d["label"])
+            return self._training_docs
 
     def validation_docs(self):
         return self.dataset["validation"]
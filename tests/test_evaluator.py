@@ -1,8 +1,13 @@
 import os
 import random
+import types
+import unittest.mock as mock
+
+import datasets
 import pytest
 
 import lm_eval
+import lm_eval.api.task
 import lm_eval.tasks as tasks
 import lm_eval.api.model as model
 import lm_eval.models as models
@@ -69,3 +74,137 @@ def test_evaluator(task_name):
     )["results"]
     # Check that caching is working
     assert e1 == e2
+
+
+class _RequestsCacheTemplate:
+    """Minimal stand-in for a `promptsource` template."""
+
+    def __init__(self, name, jinja="Q: {q} A:", answer_choices="yes ||| no"):
+        self.name = name
+        self.jinja = jinja
+        self.answer_choices = answer_choices
+        self.metadata = types.SimpleNamespace(metrics=["Accuracy"], original_task=True)
+
+    def apply(self, doc):
+        return self.jinja.format(**doc), [doc["a"]]
+
+    def get_answer_choices_list(self, doc):
+        return [choice.strip() for choice in self.answer_choices.split("|||")]
+
+    def get_fixed_answer_choices_list(self):
+        # Mimic doc-dependent answer choices, which have no fixed list.
+        return None
+
+    def get_name(self):
+        return self.name
+
+    def get_id(self):
+        return self.name
+
+
+class _RequestsCacheTask(lm_eval.api.task.PromptSourceTask):
+    DATASET_PATH = "requests_cache_task"
+
+    def download(self, *args, **kwargs):
+        self.dataset = datasets.DatasetDict(
+            {
+                split: datasets.Dataset.from_dict(
+                    {
+                        "q": [f"{split} question {i}" for i in range(30)],
+                        "a": ["yes" if i % 3 else "no" for i in range(30)],
+                    }
+                )
+                for split in ["train", "validation"]
+            }
+        )
+
+    def has_training_docs(self):
+        return True
+
+    def has_validation_docs(self):
+        return True
+
+    def has_test_docs(self):
+        return False
+
+    def training_docs(self):
+        return self.dataset["train"]
+
+    def validation_docs(self):
+        return self.dataset["validation"]
+
+
+def _evaluate_requests_cache_task(requests_cache_dir=None, **kwargs):
+    lm = models.get_model("dummy")
+    lm.loglikelihood = _ll_fn
+    task = _RequestsCacheTask(prompt_template=_RequestsCacheTemplate("prompt"))
+    return evaluator.evaluate(
+        model=lm,
+        tasks=[task],
+        bootstrap_iters=10,
+        requests_cache_dir=requests_cache_dir,
+        **kwargs,
+    )["results"]
+
+
+def test_requests_cache_round_trip(tmp_path):
+    expected = _evaluate_requests_cache_task(num_fewshot=1)
+    # Cache miss: requests are built and saved.
+    assert _evaluate_requests_cache_task(tmp_path, num_fewshot=1) == expected
+    assert len(list(tmp_path.glob("requests_*.pkl"))) == 1
+    # Cache hit: requests are loaded instead of being built again.
+    with mock.patch.object(
+        evaluator, "_construct_requests", side_effect=AssertionError
+    ):
+        assert _evaluate_requests_cache_task(tmp_path, num_fewshot=1) == expected
+
+
+@pytest.mark.parametrize(
+    "changes",
+    [
+        {"num_fewshot": 1},
+        {"seed": DEFAULT_SEED + 1},
+        {"limit": 5},
+        {"template": _RequestsCacheTemplate("other prompt")},
+        {"template": _RequestsCacheTemplate("prompt", jinja="{q}?")},
+        {"template": _RequestsCacheTemplate("prompt", answer_choices="no ||| yes")},
+    ],
+)
+def test_requests_cache_key(changes):
+    def _key(num_fewshot=0, seed=DEFAULT_SEED, limit=None, template=None):
+        task = _RequestsCacheTask(
+            prompt_template=template or _RequestsCacheTemplate("prompt")
+        )
+        return evaluator._get_requests_cache_key(
+            {"task": task}, num_fewshot=num_fewshot, seed=seed, limit=limit
+        )
+
+    assert _key() == _key()
+    assert _key(**changes) != _key()
+
+
+def test_requests_cache_key_task_source():
+    task = _RequestsCacheTask(prompt_template=_RequestsCacheTemplate("prompt"))
+    key = evaluator._get_requests_cache_key({"task": task}, num_fewshot=0, seed=0)
+    # Editing how a task builds its prompts must invalidate cached requests,
+    # even without a `VERSION` bump.
+    with mock.patch.object(
+        evaluator.inspect, "getsource", return_value="def doc_to_text(): ..."
+    ):
+        edited_key = evaluator._get_requests_cache_key(
+            {"task": task}, num_fewshot=0, seed=0
+        )
+    assert edited_key != key
+
+
+def test_requests_cache_interrupted_write(tmp_path):
+    def _interrupted_dump(obj, f):
+        f.write(b"truncated")
+        raise KeyboardInterrupt
+
+    with mock.patch.object(evaluator.pickle, "dump", side_effect=_interrupted_dump):
+        with pytest.raises(KeyboardInterrupt):
+            _evaluate_requests_cache_task(tmp_path)
+    # No partial cache file is left behind for later runs to load.
+    assert list(tmp_path.iterdir()) == []
+    assert _evaluate_requests_cache_task(tmp_path) == _evaluate_requests_cache_task()
@@ -12,3 +12,18 @@ def test_bootstrapping():
     bootstrapped = metrics.bootstrap_stderr(metrics.mean, arr, iters=100000)
 
     assert bootstrapped == pytest.approx(expected, abs=1e-4)
+
+
+def test_bootstrapping_perplexity():
+    random.seed(DEFAULT_SEED)
+    arr = [-random.random() for _ in range(1000)]
+    # Delta method: SE(exp(-mean)) ~= exp(-mean) * SE(mean)
+    expected = metrics.perplexity(arr) * metrics.mean_stderr(arr)
+    bootstrapped = metrics.bootstrap_stderr(metrics.perplexity, arr, iters=100000)
+
+    assert bootstrapped == pytest.approx(expected, rel=1e-2)
+
+
+def test_bootstrapping_single_iter():
+    # A single replicate has no spread, as in `sample_stddev`.
+    assert metrics.bootstrap_stderr(metrics.mean, [0.1, 0.5, 0.9], iters=1) == 0.0
@@ -1,6 +1,8 @@
 import unittest.mock as mock
 import logging
 import pytest
+import torch
+import transformers
 
 import lm_eval.models
 from lm_eval.api.utils import set_seed
@@ -25,6 +27,10 @@ _DEVICE = "cpu"
             "big science has",
             "big science has been done in the past, but it's not the same as the science of the past. It",
         ),
+        # Multiple stop sequences: stop at whichever is generated first.
+        (["not", "say that"], "i like", "i like to say that"),
+        (["<|endoftext|>", "not"], "i like", "i like to say that I'm not"),
+        (["great", "never generated"], "big science is", "big science is a great"),
     ],
 )
 def test_causal_stop_sequences(stop_sequences, test_input, expected):
@@ -61,6 +67,17 @@ def test_causal_stop_sequences(stop_sequences, test_input, expected):
             "big science is ",
             "big science is a great way to get a better understanding of the world.",
         ),
+        # Multiple stop sequences: stop at whichever is generated first.
+        (
+            ["understanding", "better"],
+            "big science is ",
+            "big science is a great way to get a better",
+        ),
+        (
+            ["the", "."],
+            "The quick brown fox jumps over the lazy ",
+            "The quick brown fox jumps over the lazy fox.",
+        ),
     ],
 )
 def test_seq2seq_stop_sequences(stop_sequences, test_input, expected):
@@ -77,6 +94,245 @@ def test_seq2seq_stop_sequences(stop_sequences, test_input, expected):
     assert test_input + generations == expected
 
 
+@pytest.mark.parametrize(
+    "pretrained,context",
+    [
+        ("gpt2", "big science is"),
+        # Seq2seq decoder inputs only start with the decoder start token.
+        ("google/t5-small-lm-adapt", None),
+    ],
+)
+def test_stop_sequences_criteria_batch(pretrained, context):
+    tokenizer = transformers.AutoTokenizer.from_pretrained(pretrained)
+    stop_sequences = ["not", "great"]
+    # Each row finishes on a different stop sequence after a different number
+    # of generated tokens.
+    generations = [" to say that I'm not sure why", " a great deal of fun for all"]
+    generation_ids = tokenizer(generations, add_special_tokens=False)["input_ids"]
+    num_tokens = min(len(ids) for ids in generation_ids)
+    prefix_ids = (
+        tokenizer(context, add_special_tokens=False)["input_ids"]
+        if context is not None
+        else [tokenizer.pad_token_id]
+    )
+    stopping_criteria = lm_eval.models.huggingface.stop_sequences_criteria(
+        tokenizer, stop_sequences, len(prefix_ids), len(generations)
+    )
+
+    def _finish_step(ids):
+        # Number of generated tokens after which the row contains a stop sequence.
+        for step in range(1, len(ids) + 1):
+            if any(seq in tokenizer.decode(ids[:step]) for seq in stop_sequences):
+                return step
+
+    finish_steps = [_finish_step(ids[:num_tokens]) for ids in generation_ids]
+    assert finish_steps[1] < finish_steps[0] <= num_tokens
+
+    stopped = []
+    for step in range(1, num_tokens + 1):
+        input_ids = torch.tensor(
+            [prefix_ids + ids[:step] for ids in generation_ids], dtype=torch.long
+        )
+        # `generate` stops once the criteria are met for the whole batch.
+        stopped.append(bool(torch.as_tensor(stopping_criteria(input_ids, None)).all()))
+    # Generation only stops once every row has generated any stop sequence.
+    assert stopped.index(True) + 1 == finish_steps[0]
+
+
+def _bucketed_causal_model(max_length=512):
+    causal_model = lm_eval.models.huggingface.AutoCausalLM.__new__(
+        lm_eval.models.huggingface.AutoCausalLM
+    )
+    causal_model._use_torch_compile = True
+    causal_model._max_length = max_length
+    causal_model._add_special_tokens = None
+    return causal_model
+
+
+@pytest.mark.parametrize(
+    "length,expected",
+    [
+        (1, 64),
+        (64, 64),
+        (65, 128),
+        (200, 256),
+        # Buckets are capped at `max_length`...
+        (300, 400),
+        (400, 400),
+        # ...and longer batches are not padded at all.
+        (401, 401),
+    ],
+)
+def test_padded_length(length, expected):
+    causal_model = _bucketed_causal_model(max_length=400)
+    assert causal_model._padded_length(length) == expected
+    causal_model._use_torch_compile = False
+    assert causal_model._padded_length(length) == length
+
+
+@pytest.mark.parametrize("padding_side", ["left", "right"])
+def test_tok_encode_batch_bucketed(padding_side):
+    causal_model = _bucketed_causal_model()
+    causal_model.tokenizer = transformers.AutoTokenizer.from_pretrained("gpt2")
+    causal_model.tokenizer.pad_token = causal_model.tokenizer.eos_token
+    causal_model.tokenizer.padding_side = padding_side
+    strings = ["big science", "big science is a great way to get a better"]
+    input_ids = causal_model.tok_encode(strings)
+    batch = causal_model.tok_encode_batch(strings)
+    assert batch["input_ids"].shape == (2, 64)
+    for ids, row, mask in zip(input_ids, batch["input_ids"], batch["attention_mask"]):
+        tokens = row[mask.bool()].tolist()
+        assert tokens == ids
+        if padding_side == "left":
+            assert mask[-len(ids) :].all() and not mask[: -len(ids)].any()
+        else:
+            assert mask[: len(ids)].all() and not mask[len(ids) :].any()
+
+
+@pytest.mark.parametrize(
+    "quantization,expected",
+    [
+        (None, None),
+        ("int8", {"load_in_8bit": True, "llm_int8_threshold": 6.0}),
+        (
+            "nf4",
+            {
+                "load_in_4bit": True,
+                "bnb_4bit_quant_type": "nf4",
+                "bnb_4bit_compute_dtype": torch.bfloat16,
+            },
+        ),
+    ],
+)
+def test_quantization_config(quantization, expected):
+    with mock.patch.object(transformers, "BitsAndBytesConfig") as config_class:
+        config = lm_eval.models.huggingface._get_quantization_config(quantization)
+    if expected is None:
+        assert config is None
+        config_class.assert_not_called()
+    else:
+        assert config is config_class.return_value
+        config_class.assert_called_once_with(**expected)
+
+
+def test_quantization_config_unknown():
+    with pytest.raises(ValueError, match="int4"):
+        lm_eval.models.huggingface._get_quantization_config("int4")
+
+
+def test_quantization_forces_accelerate():
+    model = mock.Mock(hf_device_map={"lm_head": "cpu"})
+    with mock.patch.object(transformers, "BitsAndBytesConfig"), mock.patch.object(
+        lm_eval.models.huggingface.AutoCausalLM,
+        "_create_auto_model",
+        return_value=model,
+    ) as create_auto_model:
+        causal_model = lm_eval.models.get_model(
+            "hf-causal",
+            pretrained="gpt2",
+            device=_DEVICE,
+            quantization="int8",
+            use_torch_compile=True,
+        )
+    # Quantized weights are placed by `accelerate` and are never compiled.
+    assert create_auto_model.call_args.kwargs["device_map"] == "auto"
+    assert create_auto_model.call_args.kwargs["quantization_config"] is not None
+    model.to.assert_not_called()
+    assert not causal_model._use_torch_compile
+    assert causal_model._model_forward is model
+    assert causal_model.device == torch.device("cpu")
+
+
+@pytest.mark.parametrize(
+    "autocast_dtype,expected",
+    [(None, None), ("bfloat16", torch.bfloat16), (torch.float16, torch.float16)],
+)
+def test_autocast_dtype(autocast_dtype, expected):
+    assert lm_eval.models.huggingface._get_autocast_dtype(autocast_dtype) == expected
+
+
+@pytest.mark.parametrize("autocast_dtype", ["auto", "int8", "bf16", torch.int32])
+def test_autocast_dtype_invalid(autocast_dtype):
+    with pytest.raises(ValueError, match="autocast_dtype"):
+        lm_eval.models.huggingface._get_autocast_dtype(autocast_dtype)
+
+
+@pytest.mark.parametrize(
+    "device_map",
+    [
+        {"transformer": "cpu", "lm_head": "disk"},
+        {"transformer.wte": "disk", "transformer.h": "cpu"},
+    ],
+)
+def test_accelerate_device_skips_disk(device_map):
+    model = mock.Mock(hf_device_map=device_map)
+    with mock.patch.object(
+        lm_eval.models.huggingface.AutoCausalLM,
+        "_create_auto_model",
+        return_value=model,
+    ):
+        causal_model = lm_eval.models.get_model(
+            "hf-causal", pretrained="gpt2", device=_DEVICE, use_accelerate=True
+        )
+    assert causal_model.device == torch.device("cpu")
+
+
+def test_accelerate_device_all_disk():
+    model = mock.Mock(hf_device_map={"": "disk"})
+    with mock.patch.object(
+        lm_eval.models.huggingface.AutoCausalLM,
+        "_create_auto_model",
+        return_value=model,
+    ):
+        with pytest.raises(ValueError, match="disk"):
+            lm_eval.models.get_model(
+                "hf-causal", pretrained="gpt2", device=_DEVICE, use_accelerate=True
+            )
+
+
+def test_attn_implementation_fallback():
+    causal_model = lm_eval.models.huggingface.AutoCausalLM.__new__(
+        lm_eval.models.huggingface.AutoCausalLM
+    )
+    model = mock.Mock()
+    with mock.patch.object(
+        transformers.AutoModelForCausalLM,
+        "from_pretrained",
+        side_effect=[
+            ImportError("FlashAttention2 requires the flash_attn package."),
+            ValueError("The model does not support sdpa attention yet."),
+            model,
+        ],
+    ) as from_pretrained:
+        assert (
+            causal_model._create_auto_model(
+                pretrained="gpt2",
+                revision="main",
+                subfolder=None,
+                attn_implementation="flash_attention_2",
+            )
+            is model
+        )
+    assert [
+        call.kwargs["attn_implementation"] for call in from_pretrained.call_args_list
+    ] == ["flash_attention_2", "sdpa", "eager"]
+
+    # Unrelated errors are raised right away instead of loading the model again.
+    with mock.patch.object(
+        transformers.AutoModelForCausalLM,
+        "from_pretrained",
+        side_effect=ValueError("Invalid `device_map`."),
+    ) as from_pretrained:
+        with pytest.raises(ValueError, match="device_map"):
+            causal_model._create_auto_model(
+                pretrained="gpt2",
+                revision="main",
+                subfolder=None,
+                attn_implementation="flash_attention_2",
+            )
+    assert from_pretrained.call_count == 1
+
+
 def test_causal_model():
     set_seed()
     causal_model = lm_eval.models.get_model(
@@ -171,6 +427,36 @@ def test_causal_model():
     assert gen == ", lazy fox and they both fall to the ground"
 
 
+def test_causal_model_torch_compile():
+    requests = [
+        ("The quick brown fox jumps over the lazy", " dog"),
+        ("Hello", " World"),
+    ]
+    causal_model = lm_eval.models.get_model(
+        "hf-causal", pretrained="gpt2", device=_DEVICE
+    )
+    compiled_model = lm_eval.models.get_model(
+        "hf-causal", pretrained="gpt2", device=_DEVICE, use_torch_compile=True
+    )
+    # Generation keeps the eager forward; only scoring is compiled.
+    assert compiled_model._model_forward is not compiled_model.model
+    assert not hasattr(compiled_model.model.forward, "_torchdynamo_orig_callable")
+    for (compiled_ll, _), (ll, _) in zip(
+        compiled_model.loglikelihood(requests), causal_model.loglikelihood(requests)
+    ):
+        assert compiled_ll == pytest.approx(ll, rel=1e-3)
+    request_args = {
+        "stop_sequences": ["."],
+        "max_generation_length": 5,
+        "num_fewshot": 0,
+    }
+    assert compiled_model.greedy_until(
+        [("The quick brown fox jumps over the lazy", request_args)]
+    ) == causal_model.greedy_until(
+        [("The quick brown fox jumps over the lazy", request_args)]
+    )
+
+
 def test_causal_model_perplexity():
     set_seed()
     causal_model = lm_eval.models.get_model_from_args_string(
@@ -324,3 +610,65 @@ def test_seq2seq_model():
         [("The quick brown fox jumps over the lazy", request_args)]
     )
     assert gen == "fox"
+
+
+def test_seq2seq_model_autocast():
+    requests = [
+        ("The quick brown fox jumps over the lazy", " dog"),
+        (
+            "The term MLP is used ambiguously, sometimes loosely to any feedforward ANN",
+            ", sometimes strictly to refer to networks composed of multiple layers of perceptrons",
+        ),
+        ("Hello", " World"),
+    ]
+    fp32_model = lm_eval.models.get_model(
+        "hf-seq2seq",
+        pretrained="google/t5-small-lm-adapt",
+        device=_DEVICE,
+    )
+    bf16_model = lm_eval.models.get_model(
+        "hf-seq2seq",
+        pretrained="google/t5-small-lm-adapt",
+        device=_DEVICE,
+        autocast_dtype="bfloat16",
+    )
+    fp32_llhs = fp32_model.loglikelihood(requests)
+    bf16_llhs = bf16_model.loglikelihood(requests)
+    for (bf16_llh, _), (fp32_llh, _) in zip(bf16_llhs, fp32_llhs):
+        assert isinstance(bf16_llh, float)
+        assert bf16_llh == pytest.approx(fp32_llh, rel=2e-2)
+
+
+def test_seq2seq_model_perplexity():
+    seq2seq_model = lm_eval.models.get_model(
+        "hf-seq2seq",
+        pretrained="google/t5-small-lm-adapt",
+        device=_DEVICE,
+        batch_size=2,
+    )
+    test_strings = [
+        "We study empirical scaling laws for language model performance on the cross-entropy loss.",
+        "",
+        "Big science.",
+    ]
+    test_string_length = len(seq2seq_model.tok_encode(test_strings[0]))
+    with mock.patch.object(
+        lm_eval.models.huggingface.AutoSeq2SeqLM,
+        "max_length",
+        new_callable=mock.PropertyMock,
+    ) as mock_max_length:
+        # The last window of the first string predicts a single token, so its
+        # context is empty; the empty string is a single (EOS) token window.
+        mock_max_length.return_value = test_string_length - 1
+        with mock.patch.object(seq2seq_model.cache_hook, "add_partial") as add_partial:
+            perplexities = seq2seq_model.loglikelihood_rolling(
+                [(string,) for string in test_strings]
+            )
+        # Rolling windows are not cached.
+        add_partial.assert_not_called()
+        # Windows from different strings share batches above; scoring each
+        # string on its own must give the same results.
+        for string, perplexity in zip(test_strings, perplexities):
+            (tgt,) = seq2seq_model.loglikelihood_rolling([(string,)])
+            assert perplexity == pytest.approx(tgt, rel=1e-3)
+    assert perplexities[0] < perplexities[2] < 0.0
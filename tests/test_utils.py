@@ -2,9 +2,9 @@ import torch
 
 from lm_eval.api.utils import (
     get_rolling_token_windows,
+    logsumexp_float32,
     make_disjoint_window,
     select_continuation_from_batch_left_padding,
-    split_and_pad_windows,
 )
 
 
@@ -228,39 +228,6 @@ def test_make_disjoint_window():
     assert make_disjoint_window(([1, 2, 3, 4, 5], [4, 5, 6])) == ([1, 2, 3], [4, 5, 6])
 
 
-def test_pad_windows():
-    token_list = [100, 19, 3, 9, 794, 7142, 81, 1327, 5]
-    # Representation: [([context], [continuation]), ...]
-    # [
-    #   ([1], [100, 19, 3, 9]),
-    #   ([9], [794, 7142, 81, 1327]),
-    #   ([ ], [5])
-    # ]
-    rolling_token_windows = list(
-        map(
-            make_disjoint_window,
-            get_rolling_token_windows(
-                token_list=token_list,
-                prefix_token=1,
-                max_seq_len=4,
-                context_len=1,
-            ),
-        )
-    )
-    expected = (
-        [[1], [9], [1]],  # Split & padded contexts.
-        [
-            [100, 19, 3, 9],
-            [794, 7142, 81, 1327],
-            [5, 1, 1, 1],
-        ],  # Split & padded continuations.
-    )
-    padded_windows = split_and_pad_windows(
-        rolling_token_windows, pad_token_id=1, max_seq_len=4
-    )
-    assert padded_windows == expected
-
-
 def test_select_continuation_from_batch_1():
     generations = torch.tensor(
         [
@@ -283,3 +250,14 @@ def test_select_continuation_from_batch_1():
         select_continuation_from_batch_left_padding(generations, max_context_size),
         expected,
     )
+
+
+def test_logsumexp_float32():
+    torch.manual_seed(1234)
+    logits = (torch.randn(2, 5, 1000) * 10).to(torch.bfloat16)
+    expected = logits.float().logsumexp(dim=-1)
+    # A small `max_numel` splits the positions into several chunks.
+    for max_numel in (2**26, 2 * 1000, 1):
+        lse = logsumexp_float32(logits, max_numel=max_numel)
+        assert lse.dtype == torch.float32
+        assert torch.allclose(lse, expected, rtol=0.0, atol=1e-4)